@@ -8,7 +8,7 @@ Created on Thu Jan 23 16:16:43 2025
 import pygame, sys
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.integrate import ode
+from stiffness import AutoODE
 
 # set up the colors
 BLACK = (0, 0, 0)
@@ -51,7 +51,7 @@ class Simulation:
         
         self.paused = True # starting in paused mode
 
-        self.solver = ode(self.f)
+        self.solver = AutoODE(self.f, self.jac)
         self.solver.set_integrator('dop853')
         self.solver.set_f_params(self.gamma, self.gravity)
 
@@ -59,6 +59,9 @@ class Simulation:
         self.dstate = np.array([state[2],state[3], - arg1* state[2], - arg1 * state[3] - arg2])
         return self.dstate
 
+    def jac(self, t, state, arg1, arg2):
+        return np.array([[0, 0, 1, 0], [0, 0, 0, 1], [0, 0, -arg1, 0], [0, 0, 0, -arg1]])
+
     def setup(self, speed, angle_degrees):
         self.vel[0] = np.cos(angle_degrees/180 *np.pi)*speed
         self.vel[1] = np.sin(angle_degrees/180 *np.pi)*speed
@@ -102,6 +105,33 @@ def sim_to_screen(win_height, x, y):
 
     return x, win_height - y
 
+_export_sprites = {} # one sprite per worker process
+
+def render_projectile(pos, win_width=640, win_height=640):
+    # one frame with the projectile at pos, drawn off screen
+    import video
+    if 'ball' not in _export_sprites:
+        _export_sprites['ball'] = MyCircle(RED, 5, 5)
+    sprite = _export_sprites['ball']
+    sprite.rect.x, sprite.rect.y = sim_to_screen(win_height, pos[0], pos[1])
+    screen = pygame.Surface((win_width, win_height))
+    screen.fill(WHITE)
+    screen.blit(sprite.image, sprite.rect)
+    return video.surface_image(screen)
+
+def export_projectile(outfile='projectile.mp4', speed=70., angle_degrees=50, workers=None):
+    # simulate the whole flight first, as main() does, then render the
+    # frames on a process pool
+    import video
+
+    sim = Simulation()
+    sim.setup(speed, angle_degrees)
+    frames_pos = [sim.pos.copy()]
+    while sim.pos[1] > -1.:
+        sim.step()
+        frames_pos.append(sim.pos.copy())
+    return video.export_video(render_projectile, frames_pos, outfile, workers=workers)
+
 def main():
 
     # initializing pygame
@@ -178,4 +208,7 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if sys.argv[1:2] == ['export']: # python Lab2.py export [outfile], video without a window
+        export_projectile(*sys.argv[2:3])
+    else:
+        main()
\ No newline at end of file
@@ -7,7 +7,10 @@ Created on Tue Feb 11 18:15:34 2025
 import pygame, sys
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.integrate import ode
+from scipy.integrate import BDF
+from stiffness import AutoODE
+import scipy.sparse as sp
+from scipy.sparse.linalg import spsolve, cg
 
 # set up the colors
 BLACK = (0, 0, 0)
@@ -49,16 +52,20 @@ class SpringMass(pygame.sprite.Sprite):
         self.g = g #arg4
         self.l = l #arg5
         self.t = 0.0
+        self.asleep = False # see weightSystem.check_sleep
+        self.still = 0
         
         
-        self.solver = ode(self.f) # set up ode solver
+        self.solver = AutoODE(self.f) # set up ode solver
         self.solver.set_integrator('dop853') # set solver to use RK4
         self.solver.set_f_params(self.mass, self.k, self.c, self.g, self.l)
         
-    def f(self, t, state, arg1, arg2, arg3, arg4, arg5):
+    def f(self, t, state, arg1, arg2, arg3, arg4, arg5, spring1=None, spring2=None):
+        # spring1/spring2 override the spring end points, so a coupled solver
+        # can pass the positions of the other weights at the same instant
         posWeight = np.array([state[0], state[1]])
-        posSpring1 = self.spring1
-        posSpring2 = self.spring2
+        posSpring1 = self.spring1 if spring1 is None else spring1
+        posSpring2 = self.spring2 if spring2 is None else spring2
         vel = np.array([state[2], state[3]])
         
         if vel[0] == 0 and vel[1] == 0: #check if velocity is zero
@@ -128,8 +135,524 @@ class SpringMass(pygame.sprite.Sprite):
         self.vel[1] = self.state[3]
         
         
+def spring_links(weights):
+    # for every weight, the index of the weight at the end of spring1 and of
+    # spring2, or None where the end is a fixed point or there is no spring.
+    # set_spring1/2 store the other weight's pos array itself, so identity
+    # tells which weight it is.
+    index = {id(w.pos): i for i, w in enumerate(weights)}
+    return [(index.get(id(w.spring1)), index.get(id(w.spring2))) for w in weights]
+
+_thread_pools = {} # shared by all networks, so networks stay picklable
+
+def thread_pool(threads):
+    from concurrent.futures import ThreadPoolExecutor
+    if threads not in _thread_pools:
+        _thread_pools[threads] = ThreadPoolExecutor(max_workers=threads)
+    return _thread_pools[threads]
+
+def screen_points(pos, win_width, win_height):
+    # weightSystem.to_screen for an (N, 2) array of positions
+    pts = np.empty([len(pos), 2], dtype=int)
+    pts[:, 0] = (pos[:, 0] + win_width/2).astype(int)
+    pts[:, 1] = win_height - (pos[:, 1] + win_height/2).astype(int)
+    return pts
+
+class SpringNetwork:
+    """Many masses connected by springs, integrated as one system.
+
+    Masses are stored as (N, 2) position and velocity arrays and springs as
+    an edge list with a spring coefficient, damping coefficient and rest
+    length per edge.  Forces follow SpringMass.f: every spring pulls both
+    its ends towards its rest length and adds a damping force -c * v to
+    each of them, and gravity pulls every mass down.  Pinned masses do not
+    move, they take the place of the fixed points of SpringMass.
+    """
+
+    def __init__(self, pos, vel=None, mass=1.0, integrator='dop853'):
+        self.pos = np.array(pos, dtype=float)
+        n = len(self.pos)
+        self.vel = np.zeros([n, 2]) if vel is None else np.array(vel, dtype=float)
+        self.mass = np.full(n, mass, dtype=float) if np.isscalar(mass) else np.array(mass, dtype=float)
+        self.pinned = np.zeros(n, dtype=bool)
+        self.edges = np.zeros([0, 2], dtype=int)
+        self.k = np.zeros(0)
+        self.c = np.zeros(0)
+        self.l = np.zeros(0)
+        self.incidence = None
+        self.g = g
+        self.t = 0.0
+        self.dt = 0.033
+        self.solver = None
+
+        # 'dop853' is explicit.  For stiff springs 'backward_euler' takes one
+        # linearized implicit step per frame and 'bdf' runs scipy's BDF
+        # method, both with the sparse analytic jacobian.  'symplectic_euler'
+        # takes substeps cheap explicit steps per frame, for large cloths.
+        if integrator not in ('dop853', 'backward_euler', 'bdf', 'symplectic_euler'):
+            raise ValueError('unknown integrator ' + str(integrator))
+        self.integrator = integrator
+        self.substeps = 1
+        self.cg_tol = 1e-6 # relative residual of the conjugate gradient solve of 'backward_euler'
+        self.dv = None # last velocity change, the starting guess of the next solve
+        self.grid_shape = None # (n, m) if the masses form a row major grid
+        self.external = np.zeros([n, 2]) # applied forces, see apply_force
+
+        # with threads > 1 the edge list is cut into chunks of at least
+        # min_chunk springs, whose forces are computed on a thread pool into
+        # separate accumulators and summed at the end.  NumPy and the sparse
+        # products release the GIL, so the chunks really run in parallel.
+        self.threads = 1
+        self.min_chunk = 20000
+        self.chunks = None
+
+        # sleeping: a mass whose kinetic energy stays below sleep_energy and
+        # whose net force stays below sleep_force for sleep_window frames
+        # is no longer integrated, until a neighbour moves or a force is
+        # applied to it.  Disabled while sleep_energy is None.
+        self.sleep_energy = None
+        self.sleep_force = 1e-3
+        self.sleep_window = 30
+        self.asleep = np.zeros(n, dtype=bool)
+        self.still = np.zeros(n, dtype=int) # quiet frames in a row
+        self.sub = None # network of the awake masses, see subnetwork
+        self.sub_key = None
+
+    def add_springs(self, i, j, k=k, c=c, l=l): # add springs between masses i[e] and j[e]
+        i, j = np.atleast_1d(i), np.atleast_1d(j)
+        m = len(i)
+        self.edges = np.vstack([self.edges, np.column_stack([i, j])])
+        self.k = np.r_[self.k, np.broadcast_to(k, m)]
+        self.c = np.r_[self.c, np.broadcast_to(c, m)]
+        self.l = np.r_[self.l, np.broadcast_to(l, m)]
+        self.incidence = None
+        self.solver = None
+
+    def apply_force(self, i, force): # add a constant external force to mass i and wake it
+        self.external[i] += force
+        self.asleep[i] = False
+        self.still[i] = 0
+
+    def pin(self, i):
+        self.pinned[i] = True
+        self.vel[i] = 0.0
+        self.solver = None
+
+    def topology(self):
+        # sparse (N, E) incidence matrix, +1 at the first and -1 at the
+        # second mass of every spring, so that incidence @ f adds f to the
+        # first and -f to the second end.  Every spring also damps both its
+        # ends, node_damping is the summed c of each mass.
+        n, e = len(self.pos), len(self.edges)
+        rows = np.r_[self.edges[:, 0], self.edges[:, 1]]
+        vals = np.r_[np.ones(e), -np.ones(e)]
+        self.incidence = sp.csr_matrix((vals, (rows, np.r_[np.arange(e), np.arange(e)])), shape=(n, e))
+        self.node_damping = np.bincount(rows, np.r_[self.c, self.c], n)
+
+        # per chunk: its springs' ends, parameters and incidence columns
+        self.chunks = []
+        count = max(1, min(self.threads, e // self.min_chunk))
+        incidence = self.incidence.tocsc()
+        for span in np.array_split(np.arange(e), count):
+            a, b = (span[0], span[-1] + 1) if len(span) else (0, 0) # one empty chunk without springs
+            self.chunks.append((np.ascontiguousarray(self.edges[a:b, 0]), np.ascontiguousarray(self.edges[a:b, 1]),
+                                self.k[a:b], self.l[a:b], incidence[:, a:b].tocsr()))
+
+    def spring_forces(self, pos, i, j, k, l, incidence): # forces of one set of springs on every mass
+        d = np.take(pos, i, axis=0) - np.take(pos, j, axis=0) # take is much faster than fancy indexing here
+        length = np.sqrt(d[:, 0]*d[:, 0] + d[:, 1]*d[:, 1])
+        f = (k * (l / length - 1))[:, np.newaxis] * d # force on the first end
+        return incidence @ f
+
+    def forces(self, pos, vel): # net force on every mass, all springs in one pass
+        if self.incidence is None or len(self.chunks) != max(1, min(self.threads, len(self.edges) // self.min_chunk)):
+            self.topology()
+        if len(self.chunks) > 1:
+            pool = thread_pool(self.threads)
+            parts = list(pool.map(lambda chunk: self.spring_forces(pos, *chunk), self.chunks))
+            spring = parts[0]
+            for part in parts[1:]:
+                spring += part
+        else:
+            spring = self.spring_forces(pos, self.edges[:, 0], self.edges[:, 1], self.k, self.l, self.incidence)
+
+        force = spring - self.node_damping[:, np.newaxis] * vel + self.external
+        force[:, 1] -= self.mass * self.g
+        force[self.pinned] = 0.0
+        return force
+
+    def stiffness(self, pos, definite=False):
+        # sparse (2N, 2N) matrix dF/dx of the spring forces.  For a spring
+        # with d = x_i - x_j, length L and direction u the block is
+        # K = k ((1 - l/L) I + (l/L) u u^T), entering -K on the diagonal
+        # blocks (i, i), (j, j) and +K on (i, j), (j, i).  With definite
+        # the k (1 - l/L) I term of compressed springs is dropped, so that
+        # -dF/dx stays positive semidefinite (Choi and Ko, 2002).
+        n = len(pos)
+        i, j = self.edges[:, 0], self.edges[:, 1]
+        d = pos[i] - pos[j]
+        length = np.sqrt(np.sum(d*d, axis=1))
+        u = d / length[:, np.newaxis]
+        ratio = self.l / length
+        K = (self.k * ratio)[:, np.newaxis, np.newaxis] * u[:, :, np.newaxis] * u[:, np.newaxis, :]
+        stretch = self.k * (1 - ratio)
+        if definite:
+            stretch = np.maximum(stretch, 0.0)
+        K[:, 0, 0] += stretch
+        K[:, 1, 1] += stretch
+
+        rows, cols, vals = [], [], []
+        for a, b, sign in ((i, i, -1), (j, j, -1), (i, j, 1), (j, i, 1)):
+            for p in range(2):
+                for q in range(2):
+                    rows.append(2*a + p)
+                    cols.append(2*b + q)
+                    vals.append(sign * K[:, p, q])
+        Kx = sp.coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(2*n, 2*n)).tocsr()
+
+        free = np.repeat(~self.pinned, 2).astype(float) # pinned masses feel no force
+        return sp.diags(free) @ Kx
+
+    def damping(self): # dF/dv is diagonal, -c summed over the springs of each mass
+        if self.incidence is None:
+            self.topology()
+        cm = self.node_damping.copy()
+        cm[self.pinned] = 0.0
+        return -np.repeat(cm, 2)
+
+    def jac(self, t, y): # sparse jacobian of f for the BDF solver
+        n = len(self.pos)
+        pos = y[:2*n].reshape([-1, 2])
+        minv = sp.diags(np.repeat(1.0 / self.mass, 2))
+        return sp.bmat([[None, sp.identity(2*n)],
+                        [minv @ self.stiffness(pos), sp.diags(self.damping() / np.repeat(self.mass, 2))]], format='csc')
+
+    def step_backward_euler(self, h):
+        # linearized backward euler in velocity form (Baraff and Witkin,
+        # Large Steps in Cloth Simulation, 1998):
+        # (M - h dF/dv - h^2 dF/dx) dv = h (F + h dF/dx v), then x += h (v + dv)
+        # The matrix is symmetric positive definite, so it is solved with
+        # jacobi preconditioned conjugate gradients, as they do, starting
+        # from the last frame's dv.  Direct solves only when cg fails.
+        m = np.repeat(self.mass, 2)
+        v = self.vel.ravel()
+        Kx = self.stiffness(self.pos, definite=True)
+        F = self.forces(self.pos, self.vel).ravel()
+        A = sp.diags(m - h * self.damping()) - h*h * Kx
+        rhs = h * (F + h * (Kx @ v))
+
+        free = np.flatnonzero(np.repeat(~self.pinned, 2))
+        Af = A[free][:, free].tocsr()
+        x0 = self.dv[free] if self.dv is not None and len(self.dv) == len(v) else None
+        dv = np.zeros_like(v)
+        dv[free], info = cg(Af, rhs[free], x0, rtol=self.cg_tol, maxiter=len(free), M=sp.diags(1.0 / Af.diagonal()))
+        if info != 0:
+            dv[free] = spsolve(Af.tocsc(), rhs[free])
+        self.dv = dv
+        self.vel = (v + dv).reshape([-1, 2])
+        self.pos = self.pos + h * self.vel
+
+    def f(self, t, y):
+        state = y.reshape([2, -1, 2]) # positions, then velocities
+        dstate = np.empty_like(state)
+        dstate[0] = state[1]
+        dstate[1] = self.forces(state[0], state[1]) / self.mass[:, np.newaxis]
+        return dstate.ravel()
+
+    def setupOde(self):
+        self.solver = AutoODE(self.f, self.jac)
+        self.solver.set_integrator('dop853')
+        self.solver.set_initial_value(np.concatenate([self.pos.ravel(), self.vel.ravel()]), self.t)
+
+    def step_symplectic_euler(self, h): # kick with the current forces, then drift
+        self.vel += h * self.forces(self.pos, self.vel) / self.mass[:, np.newaxis]
+        self.pos += h * self.vel
+
+    def subnetwork(self, awake):
+        # the awake masses, their springs and, pinned, the sleeping or pinned
+        # masses at the other end of those springs
+        mask = awake[self.edges[:, 0]] | awake[self.edges[:, 1]]
+        edges = self.edges[mask]
+        nodes = np.union1d(np.flatnonzero(awake), edges.ravel())
+        remap = np.full(len(self.pos), -1)
+        remap[nodes] = np.arange(len(nodes))
+
+        sub = SpringNetwork(self.pos[nodes], self.vel[nodes], self.mass[nodes], self.integrator)
+        sub.g, sub.substeps, sub.t, sub.dt = self.g, self.substeps, self.t, self.dt
+        sub.threads, sub.min_chunk = self.threads, self.min_chunk
+        sub.pinned = (self.pinned | self.asleep)[nodes]
+        sub.vel[sub.pinned] = 0.0
+        sub.add_springs(remap[edges[:, 0]], remap[edges[:, 1]], self.k[mask], self.c[mask], self.l[mask])
+        return sub, nodes
+
+    def update(self):
+        if self.sleep_energy is None:
+            self.advance()
+            return
+
+        awake = ~(self.asleep | self.pinned)
+        if not np.any(awake): # everything rests, nothing to do
+            self.t += self.dt
+            return
+
+        if not np.any(self.asleep[~self.pinned]): # nothing asleep, pinned masses never move anyway
+            if self.sub is not None:
+                self.sub = self.solver = None # the full solver is out of date
+            self.advance()
+            net, nodes = self, np.arange(len(self.pos))
+        else:
+            key = awake.tobytes()
+            if self.sub is None or key != self.sub_key:
+                self.sub, self.sub_nodes = self.subnetwork(awake)
+                self.sub_key = key
+                self.solver = None
+            net, nodes = self.sub, self.sub_nodes
+            net.dt = self.dt
+            net.external = self.external[nodes]
+            net.advance()
+            self.pos[nodes] = net.pos
+            self.vel[nodes] = net.vel
+            self.t += self.dt
+
+        # put quiet masses to sleep
+        ke = 0.5 * net.mass * np.sum(net.vel*net.vel, axis=1)
+        fn = np.sqrt(np.sum(net.forces(net.pos, net.vel)**2, axis=1))
+        quiet = (ke < self.sleep_energy) & (fn < self.sleep_force)
+        self.still[nodes] = np.where(quiet, self.still[nodes] + 1, 0)
+        tired = nodes[self.still[nodes] >= self.sleep_window]
+        self.asleep[tired] = True
+        self.vel[tired] = 0.0
+
+        # wake sleeping masses next to a moving one
+        moving = np.zeros(len(self.pos), dtype=bool)
+        moving[nodes] = ke >= self.sleep_energy
+        i, j = self.edges[:, 0], self.edges[:, 1]
+        woken = np.r_[j[moving[i]], i[moving[j]]]
+        woken = woken[self.asleep[woken]]
+        self.asleep[woken] = False
+        self.still[woken] = 0
+
+    def advance(self): # integrate every mass over one frame
+        if self.integrator == 'backward_euler':
+            self.step_backward_euler(self.dt)
+            self.t += self.dt
+            return
+
+        if self.integrator == 'symplectic_euler':
+            for s in range(self.substeps):
+                self.step_symplectic_euler(self.dt / self.substeps)
+            self.t += self.dt
+            return
+
+        if self.integrator == 'bdf':
+            y = self.update_bdf()
+        else:
+            if self.solver is None:
+                self.setupOde()
+            if self.solver.successful():
+                self.solver.integrate(self.solver.t + self.dt)
+            y = self.solver.y
+            self.t = self.solver.t
+
+        state = y.reshape([2, -1, 2])
+        self.pos = state[0].copy()
+        self.vel = state[1].copy()
+
+    def update_bdf(self): # step scipy's BDF past the next frame and interpolate
+        if self.solver is None:
+            y0 = np.concatenate([self.pos.ravel(), self.vel.ravel()])
+            self.solver = BDF(self.f, self.t, y0, np.inf, jac=self.jac)
+        target = self.t + self.dt
+        while self.solver.t < target and self.solver.status == 'running':
+            self.solver.step()
+        self.t = target
+        return self.solver.dense_output()(target) if self.solver.t > target else self.solver.y
+
+    def draw(self, screen, win_width, win_height, color=GREY):
+        pts = screen_points(self.pos, win_width, win_height)
+        if self.grid_shape is not None: # one polyline per row and per column
+            grid = pts.reshape([self.grid_shape[0], self.grid_shape[1], 2])
+            for row in grid: # rows of the array are passed as they are, tolist() costs more than drawing
+                pygame.draw.lines(screen, color, False, row)
+            for col in grid.transpose([1, 0, 2]):
+                pygame.draw.lines(screen, color, False, col)
+        else:
+            pts = pts.tolist()
+            for i, j in self.edges:
+                pygame.draw.line(screen, color, pts[i], pts[j])
+
+    @classmethod
+    def from_weights(cls, weights, integrator='dop853'):
+        # build a network from SpringMass objects.  A spring end that shares
+        # its array with another weight's pos connects the two weights, any
+        # other finite end becomes a pinned anchor.
+        pos = [w.pos for w in weights]
+        vel = [w.vel for w in weights]
+        mass = [w.mass for w in weights]
+        springs = {}
+        for a, w in enumerate(weights):
+            for end, b in zip((w.spring1, w.spring2), spring_links(weights)[a]):
+                if b is None:
+                    if np.isinf(end[0]):
+                        continue
+                    b = len(pos) # new anchor
+                    pos.append(np.array(end, dtype=float))
+                    vel.append([0.0, 0.0])
+                    mass.append(1.0)
+                key = (min(a, b), max(a, b))
+                if key not in springs:
+                    springs[key] = (w.k, w.c, w.l)
+
+        network = cls(pos, vel, mass, integrator)
+        network.g = weights[0].g
+        network.pin(np.arange(len(weights), len(pos)))
+        for (a, b), (kk, cc, ll) in springs.items():
+            network.add_springs(a, b, kk, cc, ll)
+        network.t = weights[0].t
+        return network
+
+def cloth(n, m, spacing=3.0, top_left=(-150.0, 250.0), mass=0.05, k=200.0, c=0.02, pins=((0, 0), (0, -1))):
+    # n x m grid of masses, row major, with structural springs to the
+    # horizontal and vertical neighbours, shear springs along both diagonals
+    # and bend springs to the neighbours two apart.  pins are (row, column)
+    # of the masses held in place, by default the two top corners.
+    r, q = np.meshgrid(np.arange(n), np.arange(m), indexing='ij')
+    pos = np.column_stack([top_left[0] + q.ravel()*spacing, top_left[1] - r.ravel()*spacing])
+    idx = np.arange(n*m).reshape([n, m])
+
+    network = SpringNetwork(pos, mass=mass, integrator='symplectic_euler')
+    network.grid_shape = (n, m)
+    network.substeps = 8
+    for a, b, rest in ((idx[:, :-1], idx[:, 1:], spacing), # structural
+                       (idx[:-1, :], idx[1:, :], spacing),
+                       (idx[:-1, :-1], idx[1:, 1:], spacing*np.sqrt(2)), # shear
+                       (idx[:-1, 1:], idx[1:, :-1], spacing*np.sqrt(2)),
+                       (idx[:, :-2], idx[:, 2:], 2*spacing), # bend
+                       (idx[:-2, :], idx[2:, :], 2*spacing)):
+        network.add_springs(a.ravel(), b.ravel(), k, c, rest)
+    for p in pins:
+        network.pin(idx[p])
+    return network
+
+def simulate_batch(network, params, times, substeps=4):
+    # positions of the network's masses at the given times for every row
+    # (k, c, l) of params, with the same k, c and rest length on every
+    # spring.  All parameter sets are integrated together with RK4, the
+    # state has shape (B, N, 2).  Returns an array of shape (B, T, N, 2).
+    params = np.atleast_2d(np.asarray(params, dtype=float))
+    kb, cb, lb = params[:, 0:1], params[:, 1:2], params[:, 2:3]
+    B, n = len(params), len(network.pos)
+    if network.incidence is None:
+        network.topology()
+    i, j = network.edges[:, 0], network.edges[:, 1]
+    degree = np.bincount(np.r_[i, j], minlength=n)
+    free = (~network.pinned)[np.newaxis, :, np.newaxis]
+    minv = 1.0 / network.mass[np.newaxis, :, np.newaxis]
+
+    def accel(P, V):
+        d = np.take(P, i, axis=1) - np.take(P, j, axis=1) # (B, E, 2)
+        length = np.sqrt(d[..., 0]*d[..., 0] + d[..., 1]*d[..., 1])
+        f = (kb * (lb / length - 1))[..., np.newaxis] * d
+        F = (network.incidence @ f.transpose([1, 0, 2]).reshape([len(i), -1])).reshape([n, B, 2]).transpose([1, 0, 2])
+        F -= (cb * degree)[..., np.newaxis] * V
+        F[..., 1] -= network.mass * network.g
+        return F * minv * free
+
+    P = np.repeat(network.pos[np.newaxis], B, axis=0)
+    V = np.repeat(network.vel[np.newaxis], B, axis=0)
+    out = np.empty([B, len(times), n, 2])
+    t = times[0]
+    for s, target in enumerate(times):
+        h = (target - t) / substeps
+        for r in range(substeps if target > t else 0):
+            a1 = accel(P, V)
+            a2 = accel(P + 0.5*h*V, V + 0.5*h*a1)
+            a3 = accel(P + 0.5*h*(V + 0.5*h*a1), V + 0.5*h*a2)
+            a4 = accel(P + h*(V + 0.5*h*a2), V + h*a3)
+            P = P + h*V + h*h/6 * (a1 + a2 + a3)
+            V = V + h/6 * (a1 + 2*a2 + 2*a3 + a4)
+        t = target
+        out[:, s] = P
+    return out
+
+def _batch_errors(job): # worker for fit_spring_params
+    network, params, times, observed, nodes, substeps = job
+    sim = simulate_batch(network, params, times, substeps)[:, :, nodes]
+    return np.mean(np.sum((sim - observed[np.newaxis])**2, axis=-1), axis=(1, 2))
+
+def fit_spring_params(network, times, observed, candidates, nodes=None, substeps=4, chunk=500, workers=None, refine=4):
+    """Fit the spring coefficient k, damping c and rest length l.
+
+    network gives the topology, masses and initial state (for example
+    SpringNetwork.from_weights), observed the recorded positions, shape
+    (T, len(nodes), 2), at times.  Every candidate (k, c, l) is simulated in
+    vectorized batches of chunk candidates, spread over a process pool when
+    workers is given.  Then refine rounds each simulate a 5 x 5 x 5 grid,
+    again as one batch, around the best parameters so far, shrinking it
+    fourfold every round.  Forward runs are cached, so no parameter set is
+    simulated twice.  Returns the best (k, c, l) and its mean squared
+    position error.
+    """
+    times = np.asarray(times, dtype=float)
+    observed = np.asarray(observed, dtype=float)
+    candidates = np.atleast_2d(np.asarray(candidates, dtype=float))
+    nodes = np.arange(len(network.pos)) if nodes is None else np.asarray(nodes)
+    cache = {}
+
+    def evaluate(params): # errors of params, simulating only what is not cached yet
+        new = np.array([p for p in {tuple(p) for p in params} if p not in cache])
+        if len(new):
+            jobs = [(network, new[s:s+chunk], times, observed, nodes, substeps) for s in range(0, len(new), chunk)]
+            if workers and len(jobs) > 1:
+                from concurrent.futures import ProcessPoolExecutor
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    errors = np.concatenate(list(executor.map(_batch_errors, jobs)))
+            else:
+                errors = np.concatenate([_batch_errors(job) for job in jobs])
+            cache.update(zip(map(tuple, new), errors))
+        return np.array([cache[tuple(p)] for p in params])
+
+    errors = evaluate(candidates)
+    best = candidates[np.argmin(errors)]
+
+    # initial refinement step: the spacing of the candidates in each parameter
+    step = np.empty(3)
+    for d in range(3):
+        values = np.unique(candidates[:, d])
+        step[d] = np.min(np.diff(values)) if len(values) > 1 else 0.1 * abs(best[d])
+
+    offsets = np.stack(np.meshgrid(*[np.linspace(-1, 1, 5)]*3, indexing='ij'), axis=-1).reshape([-1, 3])
+    for r in range(refine):
+        grid = best + offsets * step
+        grid = grid[np.all(grid[:, 0:3] > 0, axis=1)] # k, c and l stay positive
+        errors = evaluate(grid)
+        best = grid[np.argmin(errors)]
+        step /= 4
+    return best, cache[tuple(best)]
+
+def render_network(network, win_width, win_height, pos):
+    # one frame of a network at the positions pos, drawn off screen
+    import video
+    screen = pygame.Surface((win_width, win_height))
+    screen.fill(BLACK)
+    network.pos = pos
+    network.draw(screen, win_width, win_height, WHITE)
+    return video.surface_image(screen)
+
+def export_network(network, outfile='cloth.mp4', frames=300, win_width=640, win_height=640, workers=None):
+    # simulate first, keeping the positions of every frame, then render the
+    # frames on a process pool
+    from functools import partial
+    import video
+
+    frames_pos = []
+    for i in range(frames):
+        frames_pos.append(network.pos.copy())
+        network.update()
+    return video.export_video(partial(render_network, network, win_width, win_height), frames_pos, outfile, workers=workers)
+
 class weightSystem:
-    def __init__(self, win_width, win_height):
+    def __init__(self, win_width, win_height, mode='separate', integrator='dop853'):
         self.win_width = win_width
         self.win_height = win_height
         self.w, self.h = 2.6*l, 2.6*l 
@@ -137,30 +660,132 @@ class weightSystem:
         self.weights = pygame.sprite.Group()
         self.dt = 0.033
 
+        # 'separate' gives every weight its own solver, 'coupled' integrates
+        # all weights with their own SpringMass.f as one system in lockstep,
+        # 'network' integrates all weights as one SpringNetwork
+        if mode not in ('separate', 'coupled', 'network'):
+            raise ValueError('unknown mode ' + str(mode))
+        self.mode = mode
+        self.integrator = integrator # integrator of the network in 'network' mode, see SpringNetwork
+        self.network = None
+        self.solver = None
+
+        # sleeping of resting weights, as in SpringNetwork.  Used by the
+        # 'separate' and 'network' modes, disabled while sleep_energy is None.
+        self.sleep_energy = None
+        self.sleep_force = 1e-3
+        self.sleep_window = 30
+        self.t = 0.0
+        self.threads = 1 # force threads of the network in 'network' mode
+
     def add_weight(self, weight):
         self.weights_dict[weight.name] = weight
         self.weights.add(weight)
+        self.network = None
+        self.solver = None
+
+    def f(self, t, y): # every weight's SpringMass.f, evaluated on one snapshot
+        states = y.reshape([-1, 4])
+        dstate = np.empty_like(states)
+        for a, wgt in enumerate(self.coupled):
+            ends = [end if b is None else states[b, 0:2] for end, b in zip((wgt.spring1, wgt.spring2), self.links[a])]
+            dstate[a] = wgt.f(t, states[a], wgt.mass, wgt.k, wgt.c, wgt.g, wgt.l, ends[0], ends[1])
+        return dstate.ravel()
+
+    def update_coupled(self):
+        if self.solver is None:
+            self.coupled = list(self.weights_dict.values())
+            self.links = spring_links(self.coupled)
+            y0 = np.concatenate([np.r_[w.pos, w.vel] for w in self.coupled]).astype(float)
+            self.solver = AutoODE(self.f)
+            self.solver.set_integrator('dop853')
+            self.solver.set_initial_value(y0, self.coupled[0].t)
+
+        if self.solver.successful():
+            self.solver.integrate(self.solver.t + self.dt)
+
+        states = self.solver.y.reshape([-1, 4])
+        for a, wgt in enumerate(self.coupled): # in place, other weights' springs point at these arrays
+            wgt.pos[:] = states[a, 0:2]
+            wgt.vel[:] = states[a, 2:4]
+            wgt.state = states[a].copy()
+            wgt.t = self.solver.t
+
+    def update_network(self):
+        weights = list(self.weights_dict.values())
+        if self.network is None:
+            self.network = SpringNetwork.from_weights(weights, self.integrator)
+            self.network.sleep_energy = self.sleep_energy
+            self.network.sleep_force = self.sleep_force
+            self.network.sleep_window = self.sleep_window
+        self.network.threads = self.threads
+        self.network.dt = self.dt
+        self.network.update()
+        for i, wgt in enumerate(weights): # in place, other weights' springs point at these arrays
+            wgt.pos[:] = self.network.pos[i]
+            wgt.vel[:] = self.network.vel[i]
+            wgt.state = np.r_[wgt.pos, wgt.vel]
+            wgt.t = self.network.t
+            wgt.asleep = bool(self.network.asleep[i])
 
     def to_screen(self, pos):
         x = int(pos[0] + self.win_width/2)
         y = int(pos[1] + self.win_height/2)
         return [x, self.win_height - y]
 
+    def wake(self, name): # restart a sleeping weight's solver from where it rests
+        wgt = self.weights_dict[name]
+        if wgt.asleep:
+            wgt.asleep = False
+            wgt.still = 0
+            wgt.t = self.t
+            wgt.setupOde()
+
+    def check_sleep(self):
+        weights = list(self.weights_dict.values())
+        moving = []
+        for wgt in weights:
+            if wgt.asleep:
+                moving.append(False)
+                continue
+            state = np.r_[wgt.pos, wgt.vel].astype(float)
+            force = wgt.mass * wgt.f(wgt.t, state, wgt.mass, wgt.k, wgt.c, wgt.g, wgt.l)[2:4]
+            ke = 0.5 * wgt.mass * np.dot(state[2:4], state[2:4])
+            quiet = ke < self.sleep_energy and np.linalg.norm(force) < self.sleep_force
+            wgt.still = wgt.still + 1 if quiet else 0
+            if wgt.still >= self.sleep_window:
+                wgt.asleep = True
+                wgt.vel[:] = 0.0
+            moving.append(ke >= self.sleep_energy)
+
+        for wgt, links in zip(weights, spring_links(weights)):
+            if wgt.asleep and any(b is not None and moving[b] for b in links):
+                self.wake(wgt.name)
+
     def update(self):
+        self.t += self.dt
+        if self.mode == 'network':
+            self.update_network()
+        elif self.mode == 'coupled':
+            self.update_coupled()
+
         for w in self.weights_dict:
             # Compute positions for screen
             wgt = self.weights_dict[w]
-            wgt.updateWeight(self.dt)
+            if self.mode == 'separate' and not wgt.asleep:
+                wgt.updateWeight(self.dt)
             p = self.to_screen(wgt.pos)
 
             # Update sprite locations
             wgt.rect.x, wgt.rect.y = p[0], p[1]
+        if self.mode == 'separate' and self.sleep_energy is not None:
+            self.check_sleep()
         self.weights.update()
 
     def draw(self, screen):
         self.weights.draw(screen)
         
-def main():
+def main(scene='chain'):
 
     print ('Press q to quit')
     
@@ -190,6 +815,10 @@ def main():
     system.add_weight(weight1)
     system.add_weight(weight2)
 
+    if scene == 'cloth': # python Lab4.py cloth
+        pygame.display.set_caption('Cloth')
+        network = cloth(100, 100)
+
     while True:
         clock.tick(30)    
 
@@ -203,6 +832,13 @@ def main():
         else:
             pass
 
+        if scene == 'cloth':
+            network.update()
+            screen.fill(BLACK) # clear the background
+            network.draw(screen, win_width, win_height, WHITE)
+            pygame.display.flip()
+            continue
+
         system.update()
         screen.fill(BLACK) # clear the background
         pygame.draw.line(screen, GREY, [0, win_height/2], [win_width, win_height/2])
@@ -214,4 +850,7 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if sys.argv[1:2] == ['export']: # python Lab4.py export [outfile] [frames], the cloth without a window
+        export_network(cloth(100, 100), *sys.argv[2:3], *[int(f) for f in sys.argv[3:4]])
+    else:
+        main(sys.argv[1] if len(sys.argv) > 1 else 'chain')
\ No newline at end of file
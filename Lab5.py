@@ -5,10 +5,12 @@ website: http://www.vclab.ca
 license: BSD
 """
 
+import sys
 import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib import animation
-from scipy.integrate import ode
+from scipy.integrate import solve_ivp
+from stiffness import AutoODE
 
 # Setup figure
 fig = plt.figure(1)
@@ -21,16 +23,55 @@ plt.title('Ball-Floor-Collision: Height vs. Time')
 plt.xlabel('Time')
 plt.ylabel('Height')
 
+# Trace of (time, height) samples with O(1) append
+class TraceBuffer:
+    def __init__(self, capacity=1024, window=None):
+        # Without a window the arrays double whenever they are full, so an
+        # append costs O(1) on average.  With a window only the last window
+        # samples are kept: every sample is written twice, at i and i+window,
+        # so the last window samples are always one contiguous slice and
+        # data() never has to copy.
+        self.window = window
+        size = 2*window if window else capacity
+        self.x = np.zeros(size)
+        self.y = np.zeros(size)
+        self.count = 0
+
+    def clear(self):
+        self.count = 0
+
+    def append(self, x, y):
+        if self.window:
+            i = self.count % self.window
+            self.x[i] = self.x[i+self.window] = x
+            self.y[i] = self.y[i+self.window] = y
+        else:
+            if self.count == len(self.x):
+                self.x = np.concatenate([self.x, np.zeros(len(self.x))])
+                self.y = np.concatenate([self.y, np.zeros(len(self.y))])
+            self.x[self.count] = x
+            self.y[self.count] = y
+        self.count += 1
+
+    def data(self): # views of the samples, oldest first
+        if self.window and self.count > self.window:
+            start = self.count % self.window
+            return self.x[start:start+self.window], self.y[start:start+self.window]
+        return self.x[:self.count], self.y[:self.count]
+
+trace = TraceBuffer() # TraceBuffer(window=n) keeps only the last n samples
+
 # Background for each function
 def init():
+    trace.clear()
     line.set_data([], [])
     time_text.set_text('')
     return line, time_text,
 
 # Called at each frame
 def animate(i, ball):
-    line.set_xdata(np.append(line.get_xdata(), ball.t))
-    line.set_ydata(np.append(line.get_ydata(), ball.state[0]))
+    trace.append(ball.t, ball.state[0])
+    line.set_data(*trace.data())
     time_text.set_text(time_template % ball.t)
 
     ball.update()
@@ -38,7 +79,7 @@ def animate(i, ball):
 
 # Ball simulation - bouncing ball
 class Ball:
-    def __init__(self, height):
+    def __init__(self, height, locate_collisions=False):
 
         # You don't need to change y, vy, g, dt, t and mass
         self.state = [height, 0]
@@ -50,22 +91,56 @@ class Ball:
 
         self.tol_distance = 0.00001
 
+        # with locate_collisions the exact impact time inside a step is
+        # found with an event function, instead of using the end of the step
+        self.locate_collisions = locate_collisions
+
         # We plan to use rk4
-        self.solver = ode(self.f)
+        self.solver = AutoODE(self.f, self.jac)
         self.solver.set_integrator('dop853')
         self.solver.set_initial_value(self.state, self.t)
 
     def f(self, t, y):
         return [y[1], -self.g]
 
+    def jac(self, t, y):
+        return [[0, 1], [0, 0]]
+
     def is_collision(self, state):
         return state[0] <= 0
 
+    def hit_floor(self, t, y): # event function, zero when the ball touches the floor
+        return y[0]
+    hit_floor.terminal = True # stop the integration there
+    hit_floor.direction = -1 # only while falling
+
     def respond_to_collision(self, state, t):
         vy_col = np.sqrt(2*self.g*self.h_init)
         return [self.tol_distance, vy_col], t
 
+    def update_located(self):
+        # integrate up to the next impact, respond to it at the impact time
+        # and carry on to the end of the step, so the result does not
+        # depend on dt
+        t_end = self.t + self.dt
+        state, t = np.array(self.state, dtype=float), self.t
+        while t < t_end:
+            sol = solve_ivp(self.f, (t, t_end), state, method='DOP853', events=self.hit_floor, rtol=1e-10, atol=1e-12)
+            if sol.status == 1: # stopped at an impact
+                state, t = self.respond_to_collision(sol.y_events[0][0], sol.t_events[0][0])
+                state = np.array(state, dtype=float)
+            else:
+                state, t = sol.y[:, -1], t_end
+
+        self.state = state
+        self.t = t
+        self.solver.set_initial_value(self.state, self.t)
+
     def update(self):
+        if self.locate_collisions:
+            self.update_located()
+            return
+
         new_state = self.solver.integrate(self.t + self.dt)
 
         # Collision detection
@@ -78,17 +153,194 @@ class Ball:
             self.t = collision_time
             self.solver.set_initial_value(self.state, self.t)
 
-ball = Ball(height=100)
+# Many balls - bouncing off the floor, the walls and each other
+class BallSystem:
+    def __init__(self, pos, vel, radius=1.0, mass=1.0, width=300.0, restitution=0.9):
+        self.pos = np.array(pos, dtype=float)
+        self.vel = np.array(vel, dtype=float)
+        n = len(self.pos)
+        self.radius = np.full(n, radius, dtype=float) if np.isscalar(radius) else np.array(radius, dtype=float)
+        self.mass = np.full(n, mass, dtype=float) if np.isscalar(mass) else np.array(mass, dtype=float)
+        self.width = width # walls at x = 0 and x = width, floor at y = 0
+        self.restitution = restitution
+        self.g = 9.8
+        self.dt = 0.033
+        self.t = 0
+        self.substeps = 2
+        self.iterations = 4 # impulse passes per substep
+        self.correction = 0.2 # fraction of an overlap removed per substep
+        self.slop = 0.01 # overlap that is left alone
+        self.bounce_speed = 1.0 # slower impacts do not bounce, which keeps piles at rest
+
+    def candidate_pairs(self):
+        # broadphase with a uniform grid spatial hash: cells are as wide as
+        # the largest ball, so touching balls are in the same or in adjacent
+        # cells.  Balls are sorted by cell, each cell is a contiguous run,
+        # and every ball is paired with the balls of its own cell and of
+        # four of its neighbour cells, so each pair is produced once.
+        size = 2 * self.radius.max()
+        cell = np.floor(self.pos / size).astype(np.int64)
+        cell -= cell.min(axis=0)
+        ncols = cell[:, 0].max() + 3
+        key = (cell[:, 1] + 1) * ncols + cell[:, 0] + 1 # keys of neighbours stay positive
+        order = np.argsort(key, kind='stable')
+        skey = key[order]
+
+        pairs_a, pairs_b = [], []
+        for dx, dy in ((0, 0), (1, 0), (-1, 1), (0, 1), (1, 1)):
+            target = skey + dy*ncols + dx
+            lo = np.searchsorted(skey, target, 'left')
+            hi = np.searchsorted(skey, target, 'right')
+            if dx == 0 and dy == 0:
+                lo = np.arange(len(skey)) + 1 # only later balls in the same cell
+            n = np.maximum(hi - lo, 0)
+            a = np.repeat(np.arange(len(skey)), n)
+            b = np.repeat(lo, n) + np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+            pairs_a.append(order[a])
+            pairs_b.append(order[b])
+        return np.concatenate(pairs_a), np.concatenate(pairs_b)
+
+    def resolve_contacts(self, h):
+        n = len(self.pos)
+        a, b = self.candidate_pairs()
+        x, y = self.pos[:, 0].copy(), self.pos[:, 1].copy()
+        dx, dy = x.take(b) - x.take(a), y.take(b) - y.take(a)
+        dist = np.sqrt(dx*dx + dy*dy)
+        reach = self.radius.take(a) + self.radius.take(b)
+        touch = (dist < reach) & (dist > 0)
+        a, b, dist, reach = a[touch], b[touch], dist[touch], reach[touch]
+        nx, ny = dx[touch] / dist, dy[touch] / dist
+
+        # all contacts are handled at once (Jacobi style), so the velocity
+        # change of a ball is averaged over its contacts
+        inv_mass = 1.0 / self.mass
+        inv_a, inv_b = inv_mass.take(a), inv_mass.take(b)
+        eff = 1.0 / (inv_a + inv_b) # effective mass of each contact
+        share = 1.0 / np.maximum(np.bincount(a, minlength=n) + np.bincount(b, minlength=n), 1)
+
+        # every contact aims for a normal velocity: fast approaches bounce
+        # back, the rest stop and overlaps get a push that removes a part
+        # of them within the substep
+        vx, vy = self.vel[:, 0].copy(), self.vel[:, 1].copy()
+        vn = (vx.take(b) - vx.take(a)) * nx + (vy.take(b) - vy.take(a)) * ny
+        target = np.where(vn < -self.bounce_speed, -self.restitution * vn, 0.0)
+        target = np.maximum(target, self.correction * (reach - dist - self.slop) / h)
+
+        # the walls work the same way, with the floor and walls not moving
+        e, v0 = self.restitution, self.bounce_speed
+        r = self.radius
+        floor = np.nonzero(y <= r)[0]
+        left = np.nonzero(x <= r)[0]
+        right = np.nonzero(x >= self.width - r)[0]
+        floor_v = np.where(vy[floor] < -v0, -e * vy[floor], 0.0)
+        left_v = np.where(vx[left] < -v0, -e * vx[left], 0.0)
+        right_v = np.where(vx[right] > v0, -e * vx[right], 0.0)
+
+        # the impulses are found iteratively: every pass moves the normal
+        # velocities towards their targets, the accumulated impulse is kept
+        # >= 0 so balls never pull together, and the walls are enforced
+        # after each pass so they can push back
+        total = np.zeros(len(a))
+        for it in range(self.iterations):
+            vn = (vx.take(b) - vx.take(a)) * nx + (vy.take(b) - vy.take(a)) * ny
+            J = np.maximum(total + eff * (target - vn), 0.0)
+            J, total = J - total, J
+            Ja, Jb = J * inv_a, J * inv_b
+            vx += share * (np.bincount(b, Jb * nx, n) - np.bincount(a, Ja * nx, n))
+            vy += share * (np.bincount(b, Jb * ny, n) - np.bincount(a, Ja * ny, n))
+            vy[floor] = np.maximum(vy[floor], floor_v)
+            vx[left] = np.maximum(vx[left], left_v)
+            vx[right] = np.minimum(vx[right], right_v)
+
+        self.vel[:, 0], self.vel[:, 1] = vx, vy
+        self.pos[floor, 1] = r[floor]
+        self.pos[left, 0] = r[left]
+        self.pos[right, 0] = self.width - r[right]
+
+    def update(self):
+        h = self.dt / self.substeps
+        for s in range(self.substeps):
+            self.vel[:, 1] -= self.g * h
+            self.resolve_contacts(h)
+            self.pos += h * self.vel
+        self.t += self.dt
+
+def many_balls(n=10000, width=1000.0, radius=1.0, seed=0):
+    # a block of n balls with random velocities, dropped into a box
+    rng = np.random.default_rng(seed)
+    cols = int(width / (2.5 * radius)) - 1
+    i = np.arange(n)
+    pos = np.column_stack([i % cols, i // cols]) * 2.5 * radius + 2 * radius
+    return BallSystem(pos, rng.normal(0, 2, (n, 2)), radius=radius, width=width)
+
+def animate_balls(system, frames=1200):
+    # scatter plot animation of a BallSystem in its own figure
+    fig = plt.figure(2)
+    ax = plt.axes(xlim=(0, system.width), ylim=(0, system.width / 4))
+    points = ax.scatter(system.pos[:, 0], system.pos[:, 1], s=4)
+    def step(i):
+        system.update()
+        points.set_offsets(system.pos)
+        return points,
+    return animation.FuncAnimation(fig, step, frames=frames, interval=10, blit=True, repeat=False)
+
+_export_figures = {} # one figure per worker process, reused for every frame
+
+def render_trace(times, heights, i):
+    # frame i of the height vs. time plot, drawn off screen with Agg
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import video
+
+    if 'trace' not in _export_figures:
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(xlim=(0, 300), ylim=(-200, 1000))
+        ax.grid()
+        line, = ax.plot([], [], '-')
+        text = ax.text(0.05, 0.9, '', transform=ax.transAxes)
+        ax.set_title('Ball-Floor-Collision: Height vs. Time')
+        ax.set_xlabel('Time')
+        ax.set_ylabel('Height')
+        _export_figures['trace'] = fig, line, text
+    fig, line, text = _export_figures['trace']
+    line.set_data(times[:i+1], heights[:i+1])
+    text.set_text(time_template % times[i])
+    return video.figure_image(fig)
+
+def export_trace(outfile='basic_animation.mp4', frames=1200, workers=None):
+    # simulate first, then render the frames on a process pool
+    from functools import partial
+    import video
+
+    ball = Ball(height=100, locate_collisions=True)
+    times, heights = np.zeros(frames), np.zeros(frames)
+    for i in range(frames):
+        times[i], heights[i] = ball.t, ball.state[0]
+        ball.update()
+    return video.export_video(partial(render_trace, times, heights), range(frames), outfile, workers=workers)
+
+if __name__ == '__main__':
+    ball = Ball(height=100, locate_collisions=True)
 
 
-# blit=True - only re-draw the parts that have changed.
-# repeat=False - stops when frame count reaches 999
-# fargs=(ball,) - a tuple that can be used to pass extra arguments to animate function
-anim = animation.FuncAnimation(fig, animate, fargs=(ball,), init_func=init, frames=1200, interval=10, blit=True, repeat=False)
-#plt.savefig('bouncing-ball-trace', format='png')
+    # blit=True - only re-draw the parts that have changed.
+    # repeat=False - stops when frame count reaches 999
+    # fargs=(ball,) - a tuple that can be used to pass extra arguments to animate function
+    if sys.argv[1:2] == ['balls']:
+        # python Lab5.py balls [n] - many balls bouncing off each other
+        anim = animate_balls(many_balls(int(sys.argv[2]) if len(sys.argv) > 2 else 10000))
+    elif sys.argv[1:2] == ['export']:
+        # python Lab5.py export [outfile] - headless, frames rendered in parallel
+        export_trace(*sys.argv[2:3])
+        sys.exit(0)
+    else:
+        anim = animation.FuncAnimation(fig, animate, fargs=(ball,), init_func=init, frames=1200, interval=10, blit=True, repeat=False)
+    #plt.savefig('bouncing-ball-trace', format='png')
 
-# Save the animation as an mp4.  For more information, see
-# http://matplotlib.sourceforge.net/api/animation_api.html
-# anim.save('basic_animation.mp4', fps=30, extra_args=['-vcodec', 'libx264'])
+    # Save the animation as an mp4.  For more information, see
+    # http://matplotlib.sourceforge.net/api/animation_api.html
+    # anim.save('basic_animation.mp4', fps=30, extra_args=['-vcodec', 'libx264'])
+    # or, much faster on many cores: python Lab5.py export basic_animation.mp4
 
-plt.show()
\ No newline at end of file
+    plt.show()
\ No newline at end of file
@@ -5,10 +5,10 @@ website: http://www.vclab.ca
 license: BSD
 """
 
-import pygame, sys
+import pygame, sys, math
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.integrate import ode
+from stiffness import AutoODE
 
 # set up the colors
 BLACK = (0, 0, 0)
@@ -22,9 +22,16 @@ springLength = 10
 springCoeff = 10
 dampCoeff = 0.2
 
+def quat_to_rot(q):
+    # rotation matrix of the unit quaternion q = (w, x, y, z)
+    w, x, y, z = q
+    return np.array([[1 - 2*(y*y + z*z), 2*(x*y - w*z), 2*(x*z + w*y)],
+                     [2*(x*y + w*z), 1 - 2*(x*x + z*z), 2*(y*z - w*x)],
+                     [2*(x*z - w*y), 2*(y*z + w*x), 1 - 2*(x*x + y*y)]])
+
 class RigidBody:
 
-    def __init__(self, position, mass, springRest, springConst, dampCoeff, width):
+    def __init__(self, position, mass, springRest, springConst, dampCoeff, width, orientation='matrix'):
         self.mass = mass  # - arg1
         self.width = width  # - arg2
         self.springRest = springRest # - arg3
@@ -33,19 +40,43 @@ class RigidBody:
         self.G = 9.81 # - arg6
         self.Ibody = np.identity(3)  # inertia tensor
         self.IbodyInv = np.linalg.inv(self.Ibody)  # inverse of inertia tensor
+        self.IbodyInv_list = self.IbodyInv.tolist()  # the same as floats, for f_quat
         self.v = np.zeros(3)  # linear velocity
         self.omega = np.zeros(3)  # angular velocity
 
-        self.state = np.zeros(19)
-        self.state[0:3] = position  # position of COM
-        self.state[3:12] = np.identity(3).reshape([1, 9])  # rotation
-        self.state[12:15] = self.mass * self.v  # linear momentum
-        self.state[15:18] = np.zeros(3)  # angular momentum
+        # 'matrix' keeps the rotation as a 3x3 matrix, 19 elements:
+        #   position 0:3, rotation 3:12, linear momentum 12:15, angular momentum 15:18
+        # 'quaternion' keeps it as a unit quaternion (w, x, y, z), 13 elements:
+        #   position 0:3, quaternion 3:7, linear momentum 7:10, angular momentum 10:13
+        if orientation not in ('matrix', 'quaternion'):
+            raise ValueError('unknown orientation ' + str(orientation))
+        self.orientation = orientation
+        if orientation == 'matrix':
+            self.state = np.zeros(19)
+            self.state[0:3] = position  # position of COM
+            self.state[3:12] = np.identity(3).reshape([1, 9])  # rotation
+            self.state[12:15] = self.mass * self.v  # linear momentum
+            self.state[15:18] = np.zeros(3)  # angular momentum
+            self.P, self.L = slice(12, 15), slice(15, 18)
+        else:
+            self.state = np.zeros(13)
+            self.state[0:3] = position  # position of COM
+            self.state[3:7] = [1, 0, 0, 0]  # rotation
+            self.state[7:10] = self.mass * self.v  # linear momentum
+            self.state[10:13] = np.zeros(3)  # angular momentum
+            self.P, self.L = slice(7, 10), slice(10, 13)
+            self.rate = np.zeros(13) # returned by f_quat, so it allocates no arrays
 
         # Setting up the solver
-        self.solver = ode(self.f)
+        self.solver = AutoODE(self.f if orientation == 'matrix' else self.f_quat)
         self.solver.set_integrator('dop853')
-        self.solver.set_f_params(self.mass, self.width, self.springRest, self.springConst, self.dampCoeff, self.G, self.IbodyInv)
+        if orientation == 'matrix':
+            self.solver.set_f_params(self.mass, self.width, self.springRest, self.springConst, self.dampCoeff, self.G, self.IbodyInv)
+        else:
+            # the quaternion is renormalized after every accepted step
+            # instead of inside f.  scipy hands f_params to solout as well,
+            # so f_quat reads the parameters from the body instead.
+            self.solver.set_solout(self.normalize)
 
     def f(self, t, state, mass, width, springRest, springConst, dampCoeff, G, IbodyInv):
         rate = np.zeros(19)
@@ -61,7 +92,7 @@ class RigidBody:
 
         forceF = -dampCoeff * rate[0:3] # calculate damping force in spring
 
-        p1 = np.matmul(state[6:15].reshape([3, 3]), np.array([0.5, 0.5, 0])) + state[0:3]  # position of point 1 (where spring attached) in world coordinates
+        p1 = np.matmul(_R, np.array([0.5, 0.5, 0])) + state[0:3]  # position of point 1 (where spring attached) in world coordinates
         lenSpring = np.linalg.norm(p1)
         deformation = lenSpring - springRest
         springUnitVec = p1/lenSpring
@@ -77,6 +108,68 @@ class RigidBody:
         rate[15:18] = torque
         return rate
 
+    def f_quat(self, t, state):
+        # f for the quaternion layout, the same forces worked out on floats
+        # so that no temporary arrays are made
+        mass, springRest, springConst, dampCoeff, G = self.mass, self.springRest, self.springConst, self.dampCoeff, self.G
+        x0, x1, x2, qw, qx, qy, qz, P0, P1, P2, L0, L1, L2 = state.tolist()
+        v0, v1, v2 = P0 / mass, P1 / mass, P2 / mass
+
+        # rotation matrix of q
+        r00, r01, r02 = 1 - 2*(qy*qy + qz*qz), 2*(qx*qy - qw*qz), 2*(qx*qz + qw*qy)
+        r10, r11, r12 = 2*(qx*qy + qw*qz), 1 - 2*(qx*qx + qz*qz), 2*(qy*qz - qw*qx)
+        r20, r21, r22 = 2*(qx*qz - qw*qy), 2*(qy*qz + qw*qx), 1 - 2*(qx*qx + qy*qy)
+
+        # omega = R IbodyInv R^T L
+        b0 = r00*L0 + r10*L1 + r20*L2
+        b1 = r01*L0 + r11*L1 + r21*L2
+        b2 = r02*L0 + r12*L1 + r22*L2
+        (i00, i01, i02), (i10, i11, i12), (i20, i21, i22) = self.IbodyInv_list
+        c0 = i00*b0 + i01*b1 + i02*b2
+        c1 = i10*b0 + i11*b1 + i12*b2
+        c2 = i20*b0 + i21*b1 + i22*b2
+        w0 = r00*c0 + r01*c1 + r02*c2
+        w1 = r10*c0 + r11*c1 + r12*c2
+        w2 = r20*c0 + r21*c1 + r22*c2
+
+        # spring attached at point 1 = R (0.5, 0.5, 0) + x, with damping
+        p0 = 0.5*(r00 + r01) + x0
+        p1 = 0.5*(r10 + r11) + x1
+        p2 = 0.5*(r20 + r21) + x2
+        lenSpring = math.sqrt(p0*p0 + p1*p1 + p2*p2)
+        s = -springConst * (lenSpring - springRest) / lenSpring
+        F0 = s*p0 - dampCoeff*v0
+        F1 = s*p1 - dampCoeff*v1
+        F2 = s*p2 - dampCoeff*v2
+
+        # torque about the COM of the spring force acting along its line
+        # through p1, as in f
+        lenF = math.sqrt(F0*F0 + F1*F1 + F2*F2)
+        u0, u1, u2 = F0 / lenF, F1 / lenF, F2 / lenF
+        k = (x0 - p0)*u0 + (x1 - p1)*u1 + (x2 - p2)*u2
+        d0, d1, d2 = p0 - k*u0 - x0, p1 - k*u1 - x1, p2 - k*u2 - x2
+
+        rate = self.rate
+        rate[0] = v0
+        rate[1] = v1
+        rate[2] = v2
+        rate[3] = -0.5*(w0*qx + w1*qy + w2*qz) # dq/dt = 0.5 (0, omega) q
+        rate[4] = 0.5*(w0*qw + w1*qz - w2*qy)
+        rate[5] = 0.5*(w1*qw + w2*qx - w0*qz)
+        rate[6] = 0.5*(w2*qw + w0*qy - w1*qx)
+        rate[7] = F0
+        rate[8] = F1 - mass * G
+        rate[9] = F2
+        rate[10] = d1*F2 - d2*F1
+        rate[11] = d2*F0 - d0*F2
+        rate[12] = d0*F1 - d1*F0
+        return rate
+
+    def normalize(self, t, state):
+        # solout of the quaternion layout: keeps q a unit quaternion, the
+        # integrator carries on from the corrected state
+        state[3:7] /= np.sqrt(np.dot(state[3:7], state[3:7]))
+
     def star(self, v):
         vs = np.zeros([3, 3])
         vs[0][0] = 0
@@ -113,14 +206,16 @@ class RigidBody:
         return self.state[0:3]
 
     def get_p1(self):
-        return np.matmul(self.state[6:15].reshape([3, 3]), np.array([0.5, 0.5, 0])) + self.state[0:3]  # position of point 1 (where spring attached) in world coordinates
+        return np.matmul(self.get_rot(), np.array([0.5, 0.5, 0])) + self.state[0:3]  # position of point 1 (where spring attached) in world coordinates
 
     def get_rot(self):
+        if self.orientation == 'quaternion':
+            return quat_to_rot(self.state[3:7])
         return self.state[3:12].reshape([3, 3])
 
     def get_angle_2d(self):
         v1 = [1, 0, 0]
-        v2 = np.dot(self.state[3:12].reshape([3, 3]), v1)
+        v2 = np.dot(self.get_rot(), v1)
         cosang = np.dot(v1, v2)
         axis = np.cross(v1, v2)
         return np.degrees(np.arccos(cosang)), axis
@@ -128,18 +223,438 @@ class RigidBody:
     def prn_state(self):
         print('Pos COM', self.state[0:3])
         print('Pos p1:', self.get_p1())
-        print('Rot', self.state[3:12].reshape([3, 3]))
-        print('P', self.state[13:15])
-        print('L', self.state[15:18])
-
+        print('Rot', self.get_rot())
+        print('P', self.state[self.P])
+        print('L', self.state[self.L])
+
+
+def quat_to_rot_batch(q):
+    # rotation matrices (N, 3, 3) of the unit quaternions q (N, 4)
+    w, x, y, z = q.T
+    R = np.empty([len(q), 3, 3])
+    R[:, 0, 0] = 1 - 2*(y*y + z*z)
+    R[:, 0, 1] = 2*(x*y - w*z)
+    R[:, 0, 2] = 2*(x*z + w*y)
+    R[:, 1, 0] = 2*(x*y + w*z)
+    R[:, 1, 1] = 1 - 2*(x*x + z*z)
+    R[:, 1, 2] = 2*(y*z - w*x)
+    R[:, 2, 0] = 2*(x*z - w*y)
+    R[:, 2, 1] = 2*(y*z + w*x)
+    R[:, 2, 2] = 1 - 2*(x*x + y*y)
+    return R
+
+class RigidBodies:
+    """Many rigid bodies connected by springs, integrated as one system.
+
+    The state of body n is row n of an (N, 13) array laid out as the
+    quaternion state of RigidBody: position 0:3, quaternion 3:7, linear
+    momentum 7:10 and angular momentum 10:13.  Springs join a point fixed
+    in one body to a point fixed in another body, or to a fixed anchor in
+    the world, and act like the spring of RigidBody: -k (length - rest)
+    along the spring plus a damping force -c times the velocity of the
+    body relative to the other end.  Rotations, inverse inertia tensors,
+    forces and torques are worked out for all bodies at once, and the
+    whole system is integrated by one dop853 solver.
+    """
+
+    def __init__(self, pos, mass=1.0, width=1.0, inertia=None):
+        pos = np.array(pos, dtype=float)
+        n = len(pos)
+        self.mass = np.full(n, mass, dtype=float) if np.isscalar(mass) else np.array(mass, dtype=float)
+        self.width = np.full(n, width, dtype=float) if np.isscalar(width) else np.array(width, dtype=float)
+        self.Ibody = np.tile(np.identity(3), [n, 1, 1]) if inertia is None else np.array(inertia, dtype=float)
+        self.IbodyInv = np.linalg.inv(self.Ibody)
+        self.G = 9.81
+
+        self.state = np.zeros([n, 13])
+        self.state[:, 0:3] = pos
+        self.state[:, 3] = 1.0 # identity rotation
+
+        # springs: body a with the point ra in its frame, body b with the
+        # point rb in its frame, or the world point rb when b is -1
+        self.a = np.zeros(0, dtype=int)
+        self.b = np.zeros(0, dtype=int)
+        self.ra = np.zeros([0, 3])
+        self.rb = np.zeros([0, 3])
+        self.k = np.zeros(0)
+        self.c = np.zeros(0)
+        self.rest = np.zeros(0)
+
+        # collisions between the boxes, and with a floor at y = floor when
+        # it is not None.  Contacts are found in the xy plane, so they
+        # assume the boxes only turn about z, as in the Box2d drawing.
+        self.collisions = True
+        self.floor = None
+        self.restitution = 0.3
+        self.friction = 0.5 # Coulomb friction coefficient of the contacts
+        self.bounce_speed = 1.0 # slower impacts do not bounce
+        self.correction = 0.2 # fraction of an overlap removed by each position pass
+        self.max_correction = 0.2 # largest push of a contact in one position pass
+        self.slop = 0.005 # overlap that is left alone
+        self.iterations = 8 # impulse passes per frame
+        self.warm_start = True # start from the impulses of the last frame
+        self.position_iterations = 4 # overlap passes per frame
+        self.contact_keys = np.zeros(0, dtype=np.int64) # contacts of the last frame, sorted
+        self.contact_impulses = np.zeros([0, 2]) # their accumulated normal and friction impulses
+        self.sap_order = np.arange(n) # sweep and prune order, kept between frames
+
+        self.t = 0.0
+        self.dt = 0.033
+        self.solver = AutoODE(self.f)
+        self.solver.set_integrator('dop853')
+        self.solver.set_solout(self.normalize) # unit quaternions, once per accepted step
+        self.solver.set_initial_value(self.state.ravel(), self.t)
+
+    def add_springs(self, a, ra, b, rb, k, c, rest):
+        # a, b are body indices (b = -1 for a world anchor), ra, rb (M, 3)
+        # points and k, c, rest scalars or one value per spring
+        a, b = np.atleast_1d(a), np.atleast_1d(b)
+        m = len(a)
+        self.a = np.concatenate([self.a, a])
+        self.b = np.concatenate([self.b, b])
+        self.ra = np.concatenate([self.ra, np.broadcast_to(ra, [m, 3])])
+        self.rb = np.concatenate([self.rb, np.broadcast_to(rb, [m, 3])])
+        self.k = np.concatenate([self.k, np.broadcast_to(k, m)])
+        self.c = np.concatenate([self.c, np.broadcast_to(c, m)])
+        self.rest = np.concatenate([self.rest, np.broadcast_to(rest, m)])
+        self.solver.set_initial_value(self.state.ravel(), self.t)
+
+    def rotations(self, state=None):
+        state = self.state if state is None else state
+        return quat_to_rot_batch(state[:, 3:7])
+
+    def forces(self, state, R):
+        # total force and torque (N, 3) on every body
+        n = len(state)
+        x, v = state[:, 0:3], state[:, 7:10] / self.mass[:, np.newaxis]
+        anchored = self.b < 0
+        b = np.where(anchored, 0, self.b)
+
+        # attachment points in the world and velocities of the other ends
+        arm_a = np.einsum('nij,nj->ni', R[self.a], self.ra)
+        pa = arm_a + x[self.a]
+        pb = np.where(anchored[:, np.newaxis], self.rb, np.einsum('nij,nj->ni', R[b], self.rb) + x[b])
+        vb = np.where(anchored[:, np.newaxis], 0.0, v[b])
+
+        d = pa - pb
+        length = np.sqrt(np.einsum('ij,ij->i', d, d))
+        fa = (-self.k * (length - self.rest) / length)[:, np.newaxis] * d - self.c[:, np.newaxis] * (v[self.a] - vb)
+        ta = np.cross(arm_a, fa)
+
+        F = np.zeros([n, 3])
+        T = np.zeros([n, 3])
+        F[:, 1] = -self.mass * self.G
+        linked = ~anchored
+        arm_b = pb[linked] - x[b[linked]]
+        tb = np.cross(arm_b, -fa[linked])
+        for k in range(3):
+            F[:, k] += np.bincount(self.a, fa[:, k], n) - np.bincount(b[linked], fa[linked, k], n)
+            T[:, k] += np.bincount(self.a, ta[:, k], n) + np.bincount(b[linked], tb[:, k], n)
+        return F, T
+
+    def omega(self, state, R):
+        # angular velocities R IbodyInv R^T L of all bodies
+        Lbody = np.einsum('nji,nj->ni', R, state[:, 10:13])
+        return np.einsum('nij,njk,nk->ni', R, self.IbodyInv, Lbody)
+
+    def f(self, t, y):
+        state = y.reshape([-1, 13])
+        R = self.rotations(state)
+        w = self.omega(state, R)
+        F, T = self.forces(state, R)
+
+        rate = np.empty_like(state)
+        rate[:, 0:3] = state[:, 7:10] / self.mass[:, np.newaxis]
+        q = state[:, 3:7]
+        rate[:, 3] = -0.5 * np.einsum('ni,ni->n', w, q[:, 1:4]) # dq/dt = 0.5 (0, omega) q
+        rate[:, 4:7] = 0.5 * (w * q[:, 0:1] + np.cross(w, q[:, 1:4]))
+        rate[:, 7:10] = F
+        rate[:, 10:13] = T
+        return rate.ravel()
+
+    def normalize(self, t, y):
+        # solout: keeps every quaternion a unit quaternion
+        q = y.reshape([-1, 13])[:, 3:7]
+        q /= np.sqrt(np.einsum('ni,ni->n', q, q))[:, np.newaxis]
+
+    def update(self):
+        self.t += self.dt
+        self.state = self.solver.integrate(self.t).reshape([-1, 13])
+        if self.collisions and self.resolve_contacts():
+            self.solver.set_initial_value(self.state.ravel(), self.t) # restart from the changed momenta
+
+    def candidate_pairs(self, R):
+        # sweep and prune: bodies are kept sorted by the left edge of their
+        # axis aligned bounding boxes.  The order of the previous frame is
+        # sorted again with a stable sort (timsort), which is close to
+        # linear when the bodies moved only a little.  Each box is paired
+        # with the boxes that start before it ends, then the pairs whose
+        # boxes do not overlap in y are dropped.
+        h = 0.5 * self.width
+        ext = h[:, np.newaxis] * (np.abs(R[:, 0:2, 0]) + np.abs(R[:, 0:2, 1])) # half sizes along x and y
+        lo = self.state[:, 0:2] - ext
+        hi = self.state[:, 0:2] + ext
+
+        order = self.sap_order[np.argsort(lo[self.sap_order, 0], kind='stable')]
+        self.sap_order = order
+        start = np.arange(1, len(order) + 1)
+        end = np.searchsorted(lo[order, 0], hi[order, 0], 'right')
+        count = np.maximum(end - start, 0)
+        a = np.repeat(np.arange(len(order)), count)
+        b = np.repeat(start, count) + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        a, b = order[a], order[b]
+        keep = (lo[a, 1] <= hi[b, 1]) & (lo[b, 1] <= hi[a, 1])
+        return a[keep], b[keep]
+
+    def box_contacts(self, a, b, R):
+        # separating axis test of the pairs a, b in the xy plane.  The axes
+        # are the two edge directions of both boxes; the one with the
+        # smallest overlap gives the contact normal (from a to b) and the
+        # depth, and the contact point is the corner of the other box that
+        # reaches deepest past that face.  Returns the touching pairs.
+        h = 0.5 * self.width
+        axes_a, axes_b = R[a][:, 0:2, 0:2], R[b][:, 0:2, 0:2] # columns are the edge directions
+        axes = np.concatenate([axes_a, axes_b], axis=2)
+        d = self.state[b, 0:2] - self.state[a, 0:2]
+        reach_a = h[a][:, np.newaxis] * np.abs(np.einsum('mik,mil->mkl', axes_a, axes)).sum(axis=1)
+        reach_b = h[b][:, np.newaxis] * np.abs(np.einsum('mik,mil->mkl', axes_b, axes)).sum(axis=1)
+        dist = np.einsum('mi,mil->ml', d, axes)
+        overlap = reach_a + reach_b - np.abs(dist)
+
+        # the faces of a win near ties, so that the contacts keep their
+        # features from frame to frame for the warm start
+        best = np.argmin(overlap + [0.0, 0.0, 0.1 * self.slop, 0.1 * self.slop], axis=1)
+        m = np.arange(len(a))
+        depth = overlap[m, best]
+        touch = depth > 0
+        a, b, best, m, depth = a[touch], b[touch], best[touch], m[touch], depth[touch]
+        nrm = axes[m, :, best] * np.sign(dist[m, best])[:, np.newaxis]
+
+        # the face of the other box that faces the reference face, with a
+        # contact at each of its corners that is past the reference face
+        on_a = best < 2
+        ref = np.where(on_a, a, b)
+        inc = np.where(on_a, b, a)
+        sign = np.where(on_a, 1.0, -1.0)
+        edges = np.where(on_a[:, np.newaxis, np.newaxis], axes_b[m], axes_a[m])
+        corners, face = self.incident_corners(self.state[inc, 0:2], edges, h[inc], -sign[:, np.newaxis] * nrm)
+        depth = sign[:, np.newaxis] * np.einsum('mi,mci->mc', nrm, self.state[ref, 0:2][:, np.newaxis] - corners) + h[ref][:, np.newaxis]
+        feature = (2*best + (dist[m, best] > 0)) * 4 + face # reference face and incident face
+        return self.touching(a, b, nrm, corners, depth, feature)
+
+    def incident_corners(self, center, edges, h, facing):
+        # the two corners (M, 2, 2) of the face of each box whose outward
+        # normal is closest to facing, and the number (0 to 3) of that face;
+        # edges (M, 2, 2) has the edge directions of the boxes as columns
+        proj = np.einsum('mi,mik->mk', facing, edges)
+        k = np.argmax(np.abs(proj), axis=1)
+        m = np.arange(len(k))
+        face = center + (h * np.sign(proj[m, k]))[:, np.newaxis] * edges[m, :, k]
+        along = h[:, np.newaxis] * edges[m, :, 1 - k]
+        return np.stack([face + along, face - along], axis=1), 2*k + (proj[m, k] > 0)
+
+    def touching(self, a, b, nrm, corners, depth, feature):
+        # one contact per corner that is in contact.  feature numbers the
+        # faces that meet, together with the corner it tells the contacts
+        # of a pair apart between frames.
+        hit = depth > 0
+        pair, corner = np.nonzero(hit)
+        return a[pair], b[pair], nrm[pair], corners[hit], depth[hit], 2*feature[pair] + corner
+
+    def floor_contacts(self, R):
+        # the corners of the bottom face of every box that are below the floor
+        n = len(self.state)
+        down = np.tile([0.0, -1.0], [n, 1])
+        corners, face = self.incident_corners(self.state[:, 0:2], R[:, 0:2, 0:2], 0.5 * self.width, down)
+        depth = self.floor - corners[:, :, 1]
+        a, b, nrm, point, depth, slot = self.touching(np.full(n, n), np.arange(n), -down, corners, depth, face)
+        return b, nrm, point, depth, slot
+
+    def batches(self, a, b, n):
+        # split the contacts into batches in which no moving body appears
+        # twice (greedy colouring, the floor n does not count).  A batch is
+        # solved at once, the batches one after the other, which is
+        # Gauss-Seidel order without a loop over single contacts.
+        used = [0] * (n + 1) # bit mask of the batches every body is in
+        color = np.empty(len(a), dtype=int)
+        for m, (i, j) in enumerate(zip(a.tolist(), b.tolist())):
+            mask = used[i] | used[j]
+            c = (~mask & (mask + 1)).bit_length() - 1 # lowest free batch
+            color[m] = c
+            used[i] |= 1 << c
+            used[j] |= 1 << c
+            used[n] = 0
+        order = np.argsort(color, kind='stable')
+        return np.split(order, np.flatnonzero(np.diff(color[order])) + 1)
+
+    def resolve_contacts(self):
+        # impulse based contact response in three parts, as in Box2D.  The
+        # accumulated impulses of the last frame are applied first (warm
+        # starting), then sequential impulses stop approaching and sliding
+        # contacts, and finally a few position passes push overlapping
+        # boxes apart.  The floor is a body that does not move, index n.
+        # Returns True when the state was changed.
+        n = len(self.state)
+        R = self.rotations()
+        a, b = self.candidate_pairs(R)
+        a, b, nrm, point, depth, slot = self.box_contacts(a, b, R)
+        if self.floor is not None:
+            fb, fnrm, fpoint, fdepth, fslot = self.floor_contacts(R)
+            a = np.concatenate([a, np.full(len(fb), n)])
+            b = np.concatenate([b, fb])
+            nrm = np.concatenate([nrm, fnrm])
+            point = np.concatenate([point, fpoint])
+            depth = np.concatenate([depth, fdepth])
+            slot = np.concatenate([slot, fslot])
+        if len(a) == 0:
+            self.contact_keys = np.zeros(0, dtype=np.int64)
+            return False
+
+        # body arrays with the floor appended
+        x = np.vstack([self.state[:, 0:3], np.zeros(3)])
+        inv_mass = np.append(1.0 / self.mass, 0.0)
+        Iinv = np.zeros([n + 1, 3, 3])
+        Iinv[:n] = np.einsum('nij,njk,nlk->nil', R, self.IbodyInv, R)
+        v = np.vstack([self.state[:, 7:10] * inv_mass[:n, np.newaxis], np.zeros(3)])
+        w = np.vstack([np.einsum('nij,nj->ni', Iinv[:n], self.state[:, 10:13]), np.zeros(3)])
+
+        n3 = np.zeros([len(a), 3])
+        n3[:, 0:2] = nrm
+        t3 = np.zeros([len(a), 3]) # tangents
+        t3[:, 0], t3[:, 1] = -nrm[:, 1], nrm[:, 0]
+        p3 = np.zeros([len(a), 3])
+        p3[:, 0:2] = point
+        p3[:, 2] = x[b, 2]
+        arm_a, arm_b = p3 - x[a], p3 - x[b]
+        groups = self.batches(a, b, n)
+
+        def mass_along(u): # inverse of the effective mass of the contacts along u
+            ca, cb = np.cross(arm_a, u), np.cross(arm_b, u)
+            ia, ib = np.einsum('mij,mj->mi', Iinv[a], ca), np.einsum('mij,mj->mi', Iinv[b], cb)
+            return inv_mass[a] + inv_mass[b] + np.einsum('mi,mi->m', ca, ia) + np.einsum('mi,mi->m', cb, ib)
+
+        def along(v, w, u, g): # relative motion of the contact points g along u
+            va = v[a[g]] + np.cross(w[a[g]], arm_a[g])
+            vb = v[b[g]] + np.cross(w[b[g]], arm_b[g])
+            return np.einsum('mi,mi->m', vb - va, u[g])
+
+        def push(v, w, J, u, g): # impulse J along u on the contacts g, b gets +J and a -J
+            Ju = J[:, np.newaxis] * u[g]
+            ia, ib = a[g], b[g]
+            v[ia] -= inv_mass[ia, np.newaxis] * Ju
+            v[ib] += inv_mass[ib, np.newaxis] * Ju
+            w[ia] -= np.einsum('mij,mj->mi', Iinv[ia], np.cross(arm_a[g], Ju))
+            w[ib] += np.einsum('mij,mj->mi', Iinv[ib], np.cross(arm_b[g], Ju))
+            v[n] = w[n] = 0.0 # the floor stays put
+
+        # warm start from the contacts of the last frame with the same pair, faces and corner
+        keys = (a.astype(np.int64) * (n + 1) + b) * 64 + slot
+        total = np.zeros(len(a))
+        total_t = np.zeros(len(a))
+        Kn, Kt = mass_along(n3), mass_along(t3)
+        vn = np.zeros(len(a))
+        for g in groups: # approach speeds before any impulse, for the bounces
+            vn[g] = along(v, w, n3, g)
+        # the impulses act on the speeds half way through the next frame,
+        # so that gravity does not sink resting boxes while it is integrated
+        v[:n, 1] -= 0.5 * self.G * self.dt
+        if len(self.contact_keys) and self.warm_start:
+            k = np.minimum(np.searchsorted(self.contact_keys, keys), len(self.contact_keys) - 1)
+            old = self.contact_keys[k] == keys
+            total[old], total_t[old] = self.contact_impulses[k[old]].T
+        for g in groups:
+            push(v, w, total[g], n3, g)
+            push(v, w, total_t[g], t3, g)
+
+        # every contact aims for a normal speed: fast approaches bounce, the
+        # rest stop.  The accumulated normal impulse stays >= 0, and the
+        # friction impulse, which stops sliding, within friction times it.
+        target = np.where(vn < -self.bounce_speed, -self.restitution * vn, 0.0)
+        for it in range(self.iterations):
+            for g in groups:
+                J = np.maximum(total[g] + (target[g] - along(v, w, n3, g)) / Kn[g], 0.0)
+                J, total[g] = J - total[g], J
+                push(v, w, J, n3, g)
+                limit = self.friction * total[g]
+                Jt = np.clip(total_t[g] - along(v, w, t3, g) / Kt[g], -limit, limit)
+                Jt, total_t[g] = Jt - total_t[g], Jt
+                push(v, w, Jt, t3, g)
+
+        order = np.argsort(keys)
+        self.contact_keys = keys[order]
+        self.contact_impulses = np.column_stack([total, total_t])[order]
+
+        # position passes: every overlap beyond slop is reduced by the
+        # fraction correction, at most max_correction, moving the boxes
+        # without giving them any speed.  The depths follow the linearized
+        # motion of the contact points.
+        dx = np.zeros([n + 1, 3])
+        dtheta = np.zeros([n + 1, 3])
+        for it in range(self.position_iterations):
+            for g in groups:
+                sep = depth[g] - along(dx, dtheta, n3, g)
+                C = np.clip(self.correction * (sep - self.slop), 0.0, self.max_correction)
+                push(dx, dtheta, C / Kn[g], n3, g)
+
+        self.state[:, 0:3] += dx[:n]
+        q = self.state[:, 3:7]
+        s, u = q[:, 0:1].copy(), q[:, 1:4].copy() # q += 0.5 (0, dtheta) q
+        q[:, 0] -= 0.5 * np.einsum('ni,ni->n', dtheta[:n], u)
+        q[:, 1:4] += 0.5 * (dtheta[:n] * s + np.cross(dtheta[:n], u))
+        q /= np.sqrt(np.einsum('ni,ni->n', q, q))[:, np.newaxis]
+        v[:n, 1] += 0.5 * self.G * self.dt
+        self.state[:, 7:10] = v[:n] * self.mass[:, np.newaxis]
+        self.state[:, 10:13] = np.einsum('nij,njk,nlk,nl->ni', R, self.Ibody, R, w[:n])
+        return True
+
+    def get_angles_2d(self):
+        # rotation about z of every body, in degrees, as get_angle_2d
+        R = self.rotations()
+        return np.degrees(np.arctan2(R[:, 1, 0], R[:, 0, 0]))
+
+    def draw(self, screen, boxes):
+        # boxes is a list of Box2d sprites, one per body
+        angles = self.get_angles_2d()
+        for box, (x, y), angle in zip(boxes, self.state[:, 0:2].tolist(), angles.tolist()):
+            box.rotate(angle)
+            box.move(x, y)
+            box.draw(screen)
+
+def box_chain(n, spacing=2.0, start=(0.0, 0.0, 0.0), mass=1.0, k=springCoeff, c=dampCoeff):
+    # n boxes in a horizontal row, the first hanging from the world point
+    # start by a spring to its top left corner, every other box joined to
+    # the one before it by springs between facing corners
+    x0 = np.asarray(start, dtype=float)
+    pos = x0 + np.outer(np.arange(n) * spacing + spacing, [1.0, 0.0, 0.0])
+    bodies = RigidBodies(pos, mass)
+    h = 0.5 * bodies.width[0]
+    gap = spacing - 2*h
+    bodies.add_springs(0, [-h, h, 0], -1, x0, k, c, np.linalg.norm(pos[0] + [-h, h, 0] - x0))
+    i = np.arange(n - 1)
+    for dy in (-h, h): # lower and upper corners
+        bodies.add_springs(i, [h, dy, 0], i + 1, [-h, dy, 0], k, c, gap)
+    return bodies
+
+def box_pile(n, columns=10, width=2.0, floor=-25.0, seed=0):
+    # n boxes with random angles in a grid above a floor, to be dropped
+    rng = np.random.default_rng(seed)
+    i = np.arange(n)
+    pos = np.column_stack([(i % columns - (columns - 1)/2) * 1.6*width, floor + 2*width + (i // columns) * 1.6*width, np.zeros(n)])
+    bodies = RigidBodies(pos, width=width)
+    angle = rng.uniform(0, np.pi, n)
+    bodies.state[:, 3] = np.cos(angle/2) # rotations about z
+    bodies.state[:, 6] = np.sin(angle/2)
+    bodies.floor = floor
+    bodies.solver.set_initial_value(bodies.state.ravel(), bodies.t)
+    return bodies
 
 class Box2d(pygame.sprite.Sprite):
-    def __init__(self, x, y, screen_height, imgfile):
+    def __init__(self, x, y, screen_height, imgfile, size=50):
         pygame.sprite.Sprite.__init__(self)
 
         self.w, self.h = springLength, springLength
         self.image = pygame.image.load(imgfile)
-        self.image = pygame.transform.scale(self.image,[50,50])
+        self.image = pygame.transform.scale(self.image,[size,size])
         self.rect = self.image.get_rect()
         self.pos = (x,y)
         self.image_rot = self.image
@@ -163,7 +678,7 @@ class Box2d(pygame.sprite.Sprite):
         surface.blit(self.image_rot, rect)
 
 
-def main():
+def main(scene='single'):
     # initializing pygame
     # pygame.mixer.init()
     pygame.init()
@@ -181,10 +696,17 @@ def main():
 
     #background = pygame.image.load('background-vertical.png')
 
-    rb = RigidBody([10, 0, 0], 1, springLength, springCoeff, dampCoeff, 1)
+    rb = RigidBody([10, 0, 0], 1, springLength, springCoeff, dampCoeff, 1, orientation='quaternion')
 
     box = Box2d(rb.get_pos()[0], rb.get_pos()[1], win_height, 'square.png')
 
+    if scene == 'chain': # python Lab6.py chain [n], boxes joined by springs
+        bodies = box_chain(int(sys.argv[2]) if len(sys.argv) > 2 else 20, start=(-20.0, 20.0, 0.0))
+    elif scene == 'pile': # python Lab6.py pile [n], boxes falling on each other
+        bodies = box_pile(int(sys.argv[2]) if len(sys.argv) > 2 else 100)
+    if scene in ('chain', 'pile'):
+        boxes = [Box2d(x, y, win_height, 'square.png', size=int(10*w)) for (x, y), w in zip(bodies.state[:, 0:2], bodies.width)]
+
     cur_time = 0.0
     dt = 0.033
 
@@ -204,6 +726,13 @@ def main():
         else:
             pass
 
+        if scene in ('chain', 'pile'):
+            bodies.update()
+            screen.fill(BLACK)
+            bodies.draw(screen, boxes)
+            pygame.display.update()
+            continue
+
         rb.state = rb.solver.integrate(cur_time)
         cur_time += dt
 
@@ -228,4 +757,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main(sys.argv[1] if len(sys.argv) > 1 else 'single')
\ No newline at end of file
@@ -0,0 +1,182 @@
+"""
+Automatic switching between a non-stiff and a stiff integrator.
+
+AutoODE is a drop-in replacement for scipy's ode.  It integrates with the
+method the model asked for (dop853 in all the labs) and watches every
+integrate() call: when steps are rejected, the step size collapses or the
+solver gives up, and the Jacobian shows that the step size is held down by
+stability rather than accuracy, it switches to lsoda, which runs BDF with
+the model's Jacobian (or a finite-difference one).  While on BDF it checks the
+Jacobian every few calls and switches back once the steps the non-stiff
+method would need for stability are few compared to the steps BDF takes.
+
+Every switch is logged through the 'stiffness' logger and kept in
+AutoODE.switches as (t, from, to, reason).  To see them:
+
+    import logging
+    logging.basicConfig(level=logging.INFO)
+"""
+
+import logging
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.integrate import ode
+
+logger = logging.getLogger('stiffness')
+
+STIFF_METHODS = ('vode', 'lsoda')
+
+
+def numerical_jacobian(f, t, y, args=()):
+    # forward differences, one column per element of y
+    y = np.array(y, dtype=float)
+    f0 = np.array(f(t, y, *args), dtype=float) # copied, some models return the same buffer every call
+    J = np.empty([len(f0), len(y)])
+    for j in range(len(y)):
+        h = np.sqrt(np.finfo(float).eps) * max(abs(y[j]), 1.0)
+        yj = y[j]
+        y[j] = yj + h
+        J[:, j] = (np.array(f(t, y, *args), dtype=float) - f0) / h
+        y[j] = yj
+    return J
+
+class AutoODE(ode):
+    """scipy ode that picks between a non-stiff and a stiff method.
+
+    jac(t, y, *f_params) is the model's Jacobian; without it one is made by
+    finite differences.  A problem counts as stiff when the steps the
+    non-stiff method needs for stability alone, the largest |eigenvalue of J|
+    in the left half plane times the interval over the radius of its
+    stability region, are at least half of the steps it took.  It is no
+    longer stiff when those steps drop below switch_back times the steps
+    the stiff method took over the same interval.
+    """
+
+    def __init__(self, f, jac=None):
+        ode.__init__(self, f)
+        self.model_jac = jac
+        self.nonstiff = ('dop853', {})
+        self.stiff = False
+        self.stability = 6.0 # radius of the stability region of dop853, 5.96 on the imaginary and 6.39 on the real axis
+        self.reject_ratio = 0.2 # share of rejected steps that raises suspicion
+        self.max_steps = 200 # accepted steps per call that count as a collapsed step size
+        self.busy_steps = 50 # accepted steps that are enough for a check on every probe_every-th call
+        self.probe_every = 30 # calls between checks for stiffness without rejections, or for its end
+        self.switch_back = 0.25 # stability steps per stiff step below which the problem is no longer stiff
+        self.max_size = 1000 # larger systems are never switched, the stiff method's Jacobian is dense
+        self.switches = []
+        self.solout = None
+        self.calls = 0 # calls since the last switch
+        self.stiff_steps = 0 # steps of the stiff method since the last probe
+        self.probe_t = 0.0 # time of the last probe
+
+    def set_integrator(self, name, **integrator_params):
+        if name not in STIFF_METHODS:
+            self.nonstiff = (name, integrator_params)
+        return ode.set_integrator(self, name, **integrator_params)
+
+    def set_solout(self, solout):
+        # kept, so it can be set again after a switch back.  The stiff
+        # method has no solout, it is called at the end of every call there.
+        self.solout = solout
+        return ode.set_solout(self, solout)
+
+    def jacobian(self, t, y, *args):
+        # always with the current f_params, models change them between calls
+        if self.model_jac is not None:
+            J = self.model_jac(t, y, *self.f_params)
+            return J.toarray() if sp.issparse(J) else J
+        return numerical_jacobian(self.f, t, y, self.f_params)
+
+    def stability_steps(self, t, y, dt):
+        # steps the non-stiff method needs over dt just to stay stable.  The
+        # stability region is about a half disc, so oscillating modes on the
+        # imaginary axis count with their frequency.  Growing modes are
+        # limited by accuracy instead and are left out.
+        lam = np.linalg.eigvals(self.jacobian(t, y))
+        rate = np.max(np.abs(lam[lam.real <= 1e-3 * np.abs(lam)]), initial=0.0)
+        return rate * abs(dt) / self.stability
+
+    def switch(self, stiff, reason):
+        old = self._integrator.__class__.__name__
+        y, t = self._y.copy(), self.t
+        if stiff:
+            self.jac = self.jacobian
+            # lsoda rather than vode: vode reads a user Jacobian transposed
+            tolerances = {k: v for k, v in self.nonstiff[1].items() if k in ('rtol', 'atol')}
+            ode.set_integrator(self, 'lsoda', nsteps=5000, with_jacobian=True, **tolerances)
+        else:
+            self.jac = None
+            name, params = self.nonstiff
+            ode.set_integrator(self, name, **params)
+            if self.solout is not None:
+                ode.set_solout(self, self.solout)
+        self.set_initial_value(y, t)
+        self.stiff = stiff
+        self.calls = self.stiff_steps = 0
+        self.probe_t = t
+        new = self._integrator.__class__.__name__
+        self.switches.append((t, old, new, reason))
+        logger.info('t=%g: %s -> %s (%s)', t, old, new, reason)
+
+    def integrate(self, t, step=False, relax=False):
+        t0 = self.t
+        steps0 = self._integrator.iwork[10] if self.stiff else 0 # lsoda's step count, zero after a restart
+        y = ode.integrate(self, t, step, relax)
+        self.calls += 1
+
+        if not self.stiff:
+            if self._integrator.__class__.__name__ not in ('dopri5', 'dop853') or len(self._y) > self.max_size:
+                return y # no step statistics to watch, or too large for the stiff method
+            accepted, rejected = self._integrator.iwork[18], self._integrator.iwork[19]
+            failed = not self.successful()
+            busy = accepted > self.busy_steps and self.calls % self.probe_every == 0 # stable steps are rarely rejected
+            if failed or busy or rejected > self.reject_ratio * (accepted + rejected) or accepted > self.max_steps:
+                needed = self.stability_steps(self.t, self._y, self.t - t0)
+                if needed >= 0.5 * max(accepted, 1):
+                    reason = '%d accepted, %d rejected steps, %.0f needed for stability' % (accepted, rejected, needed)
+                    if failed:
+                        reason = 'gave up after ' + reason
+                    self.switch(True, reason)
+                    if failed: # carry on from where the non-stiff method stopped
+                        y = ode.integrate(self, t, step, relax)
+                        self.stiff_steps += self._integrator.iwork[10]
+            return y
+
+        self.stiff_steps += self._integrator.iwork[10] - steps0
+        if self.solout is not None:
+            # restart only when the solout moved y by more than the
+            # tolerance, every restart costs the stiff method its history
+            y1 = self._y.copy()
+            self.solout(self.t, y1)
+            if np.any(np.abs(y1 - self._y) > self._integrator.atol + self._integrator.rtol * np.abs(self._y)):
+                self.set_initial_value(y1, self.t)
+                y = self._y
+        if self.calls % self.probe_every == 0:
+            needed = self.stability_steps(self.t, self._y, self.t - self.probe_t)
+            if needed < self.switch_back * self.stiff_steps:
+                self.switch(False, 'stiffness cleared, %.1f steps needed for stability, %d taken' % (needed, self.stiff_steps))
+            else:
+                self.stiff_steps = 0
+                self.probe_t = self.t
+        return y
+
+def check_switching(frames=300, dt=0.033):
+    # a damped spring under gravity with k = 1e4 and c = 1e3, as a stiff
+    # Lab4 weight.  Its Jacobian is constant, so it stays stiff and has to
+    # switch to the stiff method exactly once.
+    k, c, g = 1e4, 1e3, 9.8
+    solver = AutoODE(lambda t, y: [y[1], -k*y[0] - c*y[1] - g], lambda t, y: [[0, 1], [-k, -c]])
+    solver.set_integrator('dop853')
+    solver.set_initial_value([1.0, 0.0], 0.0)
+    for i in range(frames):
+        solver.integrate(solver.t + dt)
+    assert solver.successful()
+    assert len(solver.switches) == 1 and solver.stiff, solver.switches
+    assert abs(solver.y[0] + g/k) < 1e-6 # at rest where the spring carries the weight
+    print ('switched once:', solver.switches[0])
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    check_switching()
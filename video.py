@@ -0,0 +1,96 @@
+"""
+Headless video export shared by the labs.
+
+A lab first simulates its whole trajectory and keeps one small record per
+frame (positions, angles, ...).  The records are then rendered in parallel
+by a pool of processes, each frame becoming an (height, width, 3) uint8
+image, and the images are streamed in order to ffmpeg or written as a
+numbered image sequence.  Rendering is usually the slow part, so export
+time goes down with the number of cores.
+
+The render function is sent to the worker processes, so it has to be a
+module level function (or a functools.partial of one) taking the record of
+a frame and returning its image.
+"""
+
+import os
+import shutil
+import subprocess
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def surface_image(surface):
+    # pixels of a pygame surface as an (height, width, 3) uint8 array
+    import pygame
+    return np.ascontiguousarray(pygame.surfarray.array3d(surface).swapaxes(0, 1))
+
+def figure_image(fig):
+    # pixels of a matplotlib figure drawn with the Agg backend
+    fig.canvas.draw()
+    return np.ascontiguousarray(np.asarray(fig.canvas.buffer_rgba())[:, :, :3])
+
+def _render_chunk(job): # worker for export_video
+    render, records, first, pattern = job
+    images = []
+    for i, record in enumerate(records):
+        image = render(record)
+        if pattern: # image sequences are written by the workers themselves
+            save_image(pattern % (first + i), image)
+        else:
+            images.append(image)
+    return images
+
+def save_image(filename, image):
+    from matplotlib import image as mpimg
+    mpimg.imsave(filename, image)
+
+def encoder(outfile, width, height, fps):
+    # ffmpeg reading raw rgb frames from its stdin
+    return subprocess.Popen(['ffmpeg', '-y', '-loglevel', 'error',
+                             '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '%dx%d' % (width, height), '-r', str(fps), '-i', '-',
+                             '-vcodec', 'libx264', '-pix_fmt', 'yuv420p', outfile], stdin=subprocess.PIPE)
+
+def export_video(render, records, outfile, fps=30, workers=None, chunk=8):
+    """Render one frame per record on a process pool and save the frames.
+
+    outfile is either a video file (anything ffmpeg can write, e.g.
+    'anim.mp4') or a printf style pattern for an image sequence (e.g.
+    'frames/frame%05d.png').  Without ffmpeg on the path videos fall back
+    to an image sequence next to outfile.  Returns the number of frames.
+    """
+    records = list(records)
+    pattern = outfile if '%' in outfile else None
+    if pattern is None and shutil.which('ffmpeg') is None:
+        pattern = os.path.splitext(outfile)[0] + '%05d.png'
+        print ('ffmpeg not found, writing %s instead' % pattern)
+    if pattern and os.path.dirname(pattern):
+        os.makedirs(os.path.dirname(pattern), exist_ok=True)
+
+    jobs = [(render, records[i:i+chunk], i, pattern) for i in range(0, len(records), chunk)]
+    workers = workers or os.cpu_count()
+    proc = None
+    with ProcessPoolExecutor(workers) as pool:
+        # a few chunks per worker are in flight at a time, so the frames
+        # waiting for the encoder do not pile up in memory
+        pending = deque()
+        for job in jobs:
+            pending.append(pool.submit(_render_chunk, job))
+            if len(pending) < 2 * workers:
+                continue
+            proc = _write(pending.popleft().result(), proc, outfile, fps)
+        while pending:
+            proc = _write(pending.popleft().result(), proc, outfile, fps)
+    if proc is not None:
+        proc.stdin.close()
+        proc.wait()
+    return len(records)
+
+def _write(images, proc, outfile, fps):
+    for image in images:
+        if proc is None:
+            proc = encoder(outfile, image.shape[1], image.shape[0], fps)
+        proc.stdin.write(image.tobytes())
+    return proc